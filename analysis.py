@@ -1,158 +1,857 @@
 #!/usr/bin/env python3
 # filepath: /Users/ibrahim/Documents/alibaba2/analysis.py
-from openai import OpenAI
+from collections import OrderedDict
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+import asyncio
+import base64
+import hashlib
+import importlib.util
+import io
+import mimetypes
 import os
+import re
 import sys
-import argparse
+import time
 import json
 
+# Pillow (or the SIMD-accelerated pillow-simd fork) is only needed to
+# downscale large images before they are sent, and is imported there
+_HAS_PIL = importlib.util.find_spec("PIL") is not None
 
-def get_response(image_url):
-    client = OpenAI(
-        api_key="",
-        base_url="https://dashscope-intl.aliyuncs.com/compatible-mode/v1",
-    )
-    completion = client.chat.completions.create(
-        model="qwen-vl-plus",
-        messages=[
-            {
-              "role": "user",
-              "content": [
-                {
-                  "type": "text",
-                  "text": """Analyze this food image and output the result in ONLY valid JSON format exactly as follows, with no extra explanations or text outside the JSON. Make sure to identify all possible allergens that might be present in the food:
-
-{
-  "menu": "Menu item name",
-  "description": "Brief description of the dish",
-  "location": "Optional location/restaurant info if visible",
-  "features": [
-    "Feature 1 (e.g. MSG-Free)",
-    "Feature 2 (e.g. calories info)"
-  ],
-  "foods_included": [
-    {
-      "name": "Category name (e.g. Vegetables)",
-      "items": [
-        "Food item 1",
-        "Food item 2",
-        "Food item 3"
-      ]
+# orjson parses and re-serializes the model output several times faster
+# than the stdlib json module. Without it, pysimdjson is used for parsing
+# when installed, and the stdlib json module is the last fallback. Output is
+# compact, so every result fits on one line for the Go side to scan.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    _json_loads = orjson.loads
+
+    def _json_dumps(obj):
+        return orjson.dumps(obj)
+else:
+    try:
+        import simdjson
+    except ImportError:
+        _json_loads = json.loads
+    else:
+        # A single parser is reused so its internal padded buffer is
+        # allocated once rather than on every call
+        _SIMDJSON_PARSER = simdjson.Parser()
+
+        def _json_loads(content):
+            return _SIMDJSON_PARSER.parse(content, True)
+
+    def _json_dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+MODEL = "qwen-vl-plus"
+# Ask for JSON mode until the endpoint turns out not to support it
+_JSON_MODE = True
+
+# Cap on concurrent analyses per process, tuned to the account's DashScope
+# RPM/TPM limits so bursts are queued here instead of answered with 429s.
+# An invalid value is left as 0 here and reported once arguments are parsed.
+_MAX_INFLIGHT = os.getenv("ANALYSIS_MAX_INFLIGHT", "6").strip()
+MAX_CONCURRENCY = int(_MAX_INFLIGHT) if _MAX_INFLIGHT.isdigit() else 0
+# Upper bound in seconds for a single image analysis, retries included
+REQUEST_TIMEOUT = 120.0
+# Timeout in seconds for one API attempt, a little above the usual latency
+# so a stalled call is abandoned and retried instead of waited out
+ATTEMPT_TIMEOUT = 30.0
+# Retries on timeouts, connection errors, 429 and 5xx responses. The SDK
+# backs off exponentially with jitter and honours retry-after headers; it
+# gives up at the response headers, so _stream_text retries streams that
+# stall or drop after that.
+MAX_RETRIES = 3
+
+_SEMAPHORE = asyncio.Semaphore(max(MAX_CONCURRENCY, 1))
+# time.monotonic() before which no new API call is started, pushed forward
+# whenever the server sends a retry-after header
+_THROTTLE_UNTIL = 0.0
+# When set, streamed chunks are parsed into the SDK's pydantic models instead
+# of being decoded directly; slower, but handy when debugging
+_SAFE = False
+
+# openai and httpx pull in a large import graph, so they are imported by
+# _client() on first use rather than on every start (e.g. for --help)
+openai = None
+httpx = None
+_HTTP = None
+_CLIENT = None
+
+# Images bigger than this are downscaled client-side and sent inline, so the
+# server does not fetch and encode the full-size original
+INLINE_IMAGE_THRESHOLD = 512 * 1024
+# Longest edge in pixels of a downscaled image
+MAX_IMAGE_EDGE = 1024
+
+# Analyses are cached in memory for the life of the process and, when
+# diskcache is installed, on disk across runs
+CACHE_DIR = os.path.expanduser("~/.cache/alibaba2_analysis")
+MEMORY_CACHE_SIZE = 256
+# Part of every cache key; bump it when the format of stored results changes
+CACHE_VERSION = "2"
+# Query parameters added when OSS signs a URL (V1 and V4 signatures); other
+# parameters such as x-oss-process change the image and stay in the key
+_SIGNATURE_PARAMS = {
+    "ossaccesskeyid", "expires", "signature", "security-token",
+    "x-oss-signature-version", "x-oss-credential", "x-oss-date", "x-oss-expires",
+    "x-oss-signature", "x-oss-additional-headers", "x-oss-security-token",
+}
+_USE_CACHE = True
+_MEMORY_CACHE = OrderedDict()
+_DISK_CACHE = None
+# Exceptions that mean the disk cache is unusable (unwritable directory, disk
+# full, database locked); filled in once diskcache has been imported
+_DISK_ERRORS = ()
+
+# Each mode's schema goes in the system message, kept terse since it is
+# re-sent on every call; an unchanging system prefix is also what the server
+# can cache. "structured" is the full analysis, "terse" only the fields the
+# Go caller turns into a FoodAnalysisResult.
+PROMPT_STRUCTURED = (
+    "You analyze food images. Reply with ONLY a JSON object, no prose, with keys: "
+    "menu:str, description:str (brief), location:str (restaurant/location if visible, else \"\"), "
+    "features:[str] (e.g. MSG-free), "
+    "foods_included:[{name:str (category, e.g. Vegetables), items:[str]}], "
+    "ingredients:[str], "
+    "allergens:[str] (every allergen that may be present, e.g. Eggs, Milk, Peanuts, Tree nuts, "
+    "Fish, Shellfish, Soy, Wheat, Gluten, Sesame), "
+    "nutritional_content:{calories:int, "
+    "macronutrients:{protein|carbohydrates|fat:{amount:number, unit:str, sources:[str]}}, "
+    "fiber:{amount:number, unit:str, sources:[str]}, "
+    "vitamins_minerals:{<nutrient>:str (sources)}, notes:[str]}."
+)
+PROMPT_TERSE = (
+    "You analyze food images. Reply with ONLY a JSON object, no prose, with keys: "
+    "menu:str, description:str (brief), ingredients:[str], "
+    "allergens:[str] (every allergen that may be present), "
+    "nutritional_content:{calories:int, "
+    "macronutrients:{protein|carbohydrates|fat:{amount:number, unit:str}}}."
+)
+PROMPTS = {"structured": PROMPT_STRUCTURED, "terse": PROMPT_TERSE}
+DEFAULT_MODE = "structured"
+USER_TEXT = "Analyze this food image."
+# Appended to the mode's prompt when several images share one request. JSON
+# mode only allows an object at the top level, hence the "results" wrapper.
+BATCH_TEXT = (
+    " Several images are attached. Reply with {\"results\": [...]} holding one such object"
+    " per image, in the order the images are given."
+)
+BATCH_USER_TEXT = "Analyze each of these food images."
+
+# JSON Schema mirrors of the prompts, used to check the model's output when
+# fastjsonschema is installed. Calories must be an integer because the Go
+# side unmarshals them into an int.
+_STRINGS = {"type": "array", "items": {"type": "string"}}
+_AMOUNT = {
+    "type": "object",
+    "required": ["amount", "unit"],
+    "properties": {
+        "amount": {"type": ["number", "string"]},
+        "unit": {"type": "string"},
+        "sources": _STRINGS,
     },
-    {
-      "name": "Category name (e.g. Protein)",
-      "items": [
-        "Food item 1",
-        "Food item 2"
-      ]
-    }
-  ],
-  "ingredients": [
-    "Ingredient 1",
-    "Ingredient 2",
-    "Ingredient 3"
-  ],
-  "allergens": [
-    "Eggs",
-    "Milk",
-    "Peanuts",
-    "Tree nuts",
-    "Fish",
-    "Shellfish",
-    "Soy",
-    "Wheat",
-    "Gluten",
-    "Sesame"
-  ],
-  "nutritional_content": {
-    "calories": 400,
-    "macronutrients": {
-      "protein": {
-        "amount": 25,
-        "unit": "grams",
-        "sources": ["source1", "source2"]
-      },
-      "carbohydrates": {
-        "amount": 35,
-        "unit": "grams",
-        "sources": ["source1", "source2"]
-      },
-      "fat": {
-        "amount": 15,
-        "unit": "grams",
-        "sources": ["source1", "source2"]
-      }
+}
+_NUTRITION = {
+    "type": "object",
+    "required": ["calories", "macronutrients"],
+    "properties": {
+        "calories": {"type": "integer"},
+        "macronutrients": {
+            "type": "object",
+            "required": ["protein", "carbohydrates", "fat"],
+            "properties": {"protein": _AMOUNT, "carbohydrates": _AMOUNT, "fat": _AMOUNT},
+        },
+        "fiber": _AMOUNT,
+        "vitamins_minerals": {"type": "object", "additionalProperties": {"type": "string"}},
+        "notes": _STRINGS,
     },
-    "fiber": {
-      "amount": 5,
-      "unit": "grams",
-      "sources": ["vegetables"]
+}
+SCHEMA_TERSE = {
+    "type": "object",
+    "required": ["menu", "description", "ingredients", "allergens", "nutritional_content"],
+    "properties": {
+        "menu": {"type": "string"},
+        "description": {"type": "string"},
+        "ingredients": _STRINGS,
+        "allergens": _STRINGS,
+        "nutritional_content": _NUTRITION,
     },
-    "vitamins_minerals": {
-      "vitamin_c": "Sources description",
-      "vitamin_a": "Sources description"
+}
+SCHEMA_STRUCTURED = {
+    **SCHEMA_TERSE,
+    "properties": {
+        **SCHEMA_TERSE["properties"],
+        "location": {"type": "string"},
+        "features": _STRINGS,
+        "foods_included": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "required": ["name", "items"],
+                "properties": {"name": {"type": "string"}, "items": _STRINGS},
+            },
+        },
     },
-    "notes": [
-      "Informational note 1",
-      "Informational note 2"
+}
+SCHEMAS = {"structured": SCHEMA_STRUCTURED, "terse": SCHEMA_TERSE}
+# Compiled validators by mode, built on first use; None when fastjsonschema
+# is not installed
+_VALIDATORS = {}
+
+
+_JSON_FENCE_RE = re.compile(r'```json\s*(.*?)\s*```', re.DOTALL)
+
+
+def _client():
+    """Return the shared AsyncOpenAI client, creating it on first use."""
+    global openai, httpx, _HTTP, _CLIENT
+    if _CLIENT is None:
+        import httpx
+        import openai
+
+        # One pooled HTTP client for the whole process so repeated calls reuse
+        # keep-alive connections instead of paying a TCP+TLS handshake each time
+        _HTTP = httpx.AsyncClient(
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=60.0),
+            timeout=httpx.Timeout(60.0, connect=10.0),
+            # HTTP/2 needs the optional h2 package
+            http2=importlib.util.find_spec("h2") is not None,
+        )
+        _CLIENT = openai.AsyncOpenAI(
+            api_key="",
+            base_url="https://dashscope-intl.aliyuncs.com/compatible-mode/v1",
+            http_client=_HTTP,
+            timeout=ATTEMPT_TIMEOUT,
+            max_retries=MAX_RETRIES,
+        )
+    return _CLIENT
+
+def _http():
+    """Return the pooled httpx client shared with the API client."""
+    _client()
+    return _HTTP
+
+async def _close_client():
+    # The async client has to be closed on the loop that used it,
+    # so this is done explicitly rather than through atexit
+    global _HTTP, _CLIENT
+    if _CLIENT is not None:
+        await _CLIENT.close()
+        # A later asyncio.run() gets a fresh client bound to its own loop
+        _HTTP = _CLIENT = None
+
+def _disk_cache():
+    global _DISK_CACHE, _DISK_ERRORS
+    if _DISK_CACHE is None:
+        try:
+            import diskcache
+        except ImportError:
+            # Remember that diskcache is missing instead of retrying the import
+            _DISK_CACHE = False
+        else:
+            import sqlite3
+
+            _DISK_ERRORS = (OSError, sqlite3.Error, diskcache.Timeout)
+            try:
+                _DISK_CACHE = diskcache.Cache(CACHE_DIR)
+            except _DISK_ERRORS:
+                _disable_disk_cache()
+    return _DISK_CACHE if _DISK_CACHE is not False else None
+
+def _disable_disk_cache():
+    # The cache is optional, so a broken disk layer (e.g. no writable home
+    # for a service user) leaves only the memory layer instead of failing
+    # the analysis
+    global _DISK_CACHE
+    _DISK_CACHE = False
+
+def _cache_get(key):
+    if key in _MEMORY_CACHE:
+        _MEMORY_CACHE.move_to_end(key)
+        return _MEMORY_CACHE[key]
+    disk = _disk_cache()
+    if disk is not None:
+        try:
+            value = disk.get(key)
+        except _DISK_ERRORS:
+            _disable_disk_cache()
+            return None
+        if value is not None:
+            _memory_cache_put(key, value)
+            return value
+    return None
+
+def _memory_cache_put(key, value):
+    _MEMORY_CACHE[key] = value
+    _MEMORY_CACHE.move_to_end(key)
+    if len(_MEMORY_CACHE) > MEMORY_CACHE_SIZE:
+        _MEMORY_CACHE.popitem(last=False)
+
+def _cache_put(key, value):
+    _memory_cache_put(key, value)
+    disk = _disk_cache()
+    if disk is not None:
+        try:
+            disk.set(key, value)
+        except _DISK_ERRORS:
+            _disable_disk_cache()
+
+def _image_fingerprint(image_url):
+    """Return a stable identifier for the image behind image_url."""
+    if os.path.isfile(image_url):
+        with open(image_url, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    parts = urlsplit(image_url)
+    if not parts.query:
+        return image_url
+    # Presigned OSS links get a new signature every time one is issued for
+    # the same object, so the signing parameters are left out of the key
+    query = [
+        (name, value)
+        for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if name.lower() not in _SIGNATURE_PARAMS
     ]
-  }
-}"""
-                },
-                {
-                  "type": "image_url",
-                  "image_url": {
-                    "url": image_url
-                  }
-                }
-              ]
-            }
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), ""))
+
+def _cache_key(image_url, mode):
+    fingerprint = _image_fingerprint(image_url)
+    return hashlib.sha256((CACHE_VERSION + "\0" + PROMPTS[mode] + "\0" + USER_TEXT + "\0" + fingerprint).encode()).hexdigest()
+
+def _data_url(data, mime_type):
+    return f"data:{mime_type};base64," + base64.b64encode(data).decode()
+
+def _downscale(data):
+    """Shrink image bytes to MAX_IMAGE_EDGE and return them as a JPEG data URL."""
+    from PIL import Image, ImageOps
+
+    # Apply the EXIF orientation first; the re-encoded JPEG drops the tag,
+    # so phone photos would otherwise reach the model rotated
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+    image.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), Image.LANCZOS)
+    buf = io.BytesIO()
+    image.convert("RGB").save(buf, "JPEG", quality=85, optimize=True)
+    return _data_url(buf.getvalue(), "image/jpeg")
+
+def _image_mime_type(data, content_type):
+    """Return the image MIME type for downloaded bytes, or None if unknown.
+
+    Buckets often serve uploads as binary/octet-stream or with parameters
+    such as charset, neither of which belongs in a data URL, so Pillow
+    identifies the format when the header does not name an image type.
+    """
+    mime_type = content_type.split(";", 1)[0].strip().lower()
+    if mime_type.startswith("image/"):
+        return mime_type
+    from PIL import Image
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            return Image.MIME.get(image.format)
+    except (OSError, ValueError):
+        return None
+
+async def _prepare_image_url(image_url):
+    """Return the URL to send to the model for image_url.
+
+    Local files are inlined as data URLs, and large remote images are
+    downloaded and downscaled when Pillow is available. Anything else is
+    passed through unchanged.
+    """
+    if os.path.isfile(image_url):
+        with open(image_url, "rb") as f:
+            data = f.read()
+        if _HAS_PIL and len(data) > INLINE_IMAGE_THRESHOLD:
+            return await asyncio.to_thread(_downscale, data)
+        return _data_url(data, mimetypes.guess_type(image_url)[0] or "image/jpeg")
+
+    if not _HAS_PIL or not image_url.startswith(("http://", "https://")):
+        return image_url
+    # Created before the try so its except clause can look up httpx
+    http = _http()
+    try:
+        # A GET rather than a HEAD: OSS signatures cover the HTTP verb, so a
+        # HEAD on a link signed for GET is refused. The body is only read
+        # when the headers do not already show the image is small.
+        async with http.stream("GET", image_url) as response:
+            response.raise_for_status()
+            length = response.headers.get("content-length")
+            if length is not None and int(length) <= INLINE_IMAGE_THRESHOLD:
+                return image_url
+            data = await response.aread()
+            content_type = response.headers.get("content-type", "")
+        if len(data) <= INLINE_IMAGE_THRESHOLD:
+            # Already downloaded, so send it inline rather than have the
+            # server fetch it again, unless its type cannot be told
+            mime_type = _image_mime_type(data, content_type)
+            return _data_url(data, mime_type) if mime_type else image_url
+        return await asyncio.to_thread(_downscale, data)
+    except (httpx.HTTPError, OSError, ValueError):
+        # Let the server fetch the original if it cannot be shrunk here
+        return image_url
+
+def _parse_content(content):
+    """Return the JSON value in content, or None if it is not JSON."""
+    try:
+        # Try to parse the response as JSON to check validity
+        return _json_loads(content)
+    except ValueError:
+        # If the API didn't return proper JSON, try to extract any JSON-like content
+        json_match = _JSON_FENCE_RE.search(content)
+        if json_match:
+            try:
+                return _json_loads(json_match.group(1))
+            except:
+                pass
+    return None
+
+def _coerce_calories(food_json):
+    """Turn an integral float calorie count such as 400.0 into an int, in place.
+
+    The Go side unmarshals calories into an int and rejects 400.0, while
+    fastjsonschema's "integer" type accepts it.
+    """
+    nutrition = food_json.get("nutritional_content") if isinstance(food_json, dict) else None
+    if isinstance(nutrition, dict):
+        calories = nutrition.get("calories")
+        if isinstance(calories, float) and calories.is_integer():
+            nutrition["calories"] = int(calories)
+    return food_json
+
+def _validator(mode):
+    if mode not in _VALIDATORS:
+        try:
+            import fastjsonschema
+        except ImportError:
+            _VALIDATORS[mode] = None
+        else:
+            # compile() generates a Python function specialised to the schema
+            _VALIDATORS[mode] = fastjsonschema.compile(SCHEMAS[mode])
+    return _VALIDATORS[mode]
+
+def _schema_error(food_json, mode):
+    """Return why food_json does not match the schema for mode, or None if it does."""
+    validate = _validator(mode)
+    if validate is None:
+        return None
+    try:
+        validate(food_json)
+    except ValueError as e:
+        # fastjsonschema.JsonSchemaException is a ValueError
+        return str(e)
+    return None
+
+
+def _note_retry_after(headers):
+    global _THROTTLE_UNTIL
+    try:
+        delay = float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return
+    _THROTTLE_UNTIL = max(_THROTTLE_UNTIL, time.monotonic() + delay)
+
+async def _join_chunks(stream):
+    """Return the text of an SDK stream of parsed ChatCompletionChunk models."""
+    pieces = []
+    async with stream:
+        async for chunk in stream:
+            # Chunks without choices (e.g. a trailing usage chunk) carry no text
+            if chunk.choices and chunk.choices[0].delta.content:
+                pieces.append(chunk.choices[0].delta.content)
+    return "".join(pieces)
+
+async def _join_events(response):
+    """Return the text of a raw server-sent event response.
+
+    Each chunk is decoded straight into a dict with _json_loads, which skips
+    building a pydantic model per chunk.
+    """
+    pieces = []
+    async for line in response.iter_lines():
+        if not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if data == "[DONE]":
+            break
+        chunk = _json_loads(data)
+        if chunk.get("error"):
+            raise openai.APIError(str(chunk["error"]), response.http_request, body=chunk)
+        # Chunks without choices (e.g. a trailing usage chunk) carry no text
+        choices = chunk.get("choices")
+        if choices:
+            piece = (choices[0].get("delta") or {}).get("content")
+            if piece:
+                pieces.append(piece)
+    return "".join(pieces)
+
+async def _stream_text(**kwargs):
+    """Run one streamed completion and return its text.
+
+    The SDK's retries only cover the request until the response headers
+    arrive. A stream that stalls or drops afterwards raises a bare httpx
+    error, so the whole attempt is retried here, up to MAX_RETRIES times.
+    """
+    # Created before the try so its except clauses can look up openai and httpx
+    completions = _client().chat.completions
+    for attempt in range(MAX_RETRIES + 1):
+        # Hold off while the server has asked callers to back off, so queued
+        # analyses do not each spend a round trip on another 429
+        delay = _THROTTLE_UNTIL - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        try:
+            if _SAFE:
+                # The raw response exposes the headers alongside the parsed stream
+                response = await completions.with_raw_response.create(**kwargs)
+                _note_retry_after(response.headers)
+                return await _join_chunks(response.parse())
+            async with completions.with_streaming_response.create(**kwargs) as response:
+                _note_retry_after(response.headers)
+                return await _join_events(response)
+        except openai.RateLimitError as e:
+            # Raised once the SDK's own retries are used up
+            _note_retry_after(e.response.headers)
+            raise
+        except httpx.TransportError:
+            # Read timeouts and dropped connections mid-stream; errors before
+            # the headers reach here already wrapped and retried by the SDK
+            if attempt == MAX_RETRIES:
+                raise
+            await asyncio.sleep(0.5 * 2 ** attempt)
+
+def _is_json_mode_error(error):
+    """Return whether a BadRequestError is the server refusing response_format."""
+    if getattr(error, "param", None) == "response_format":
+        return True
+    text = f"{getattr(error, 'code', None) or ''} {error.message}".lower()
+    return "response_format" in text or "json_object" in text or "json mode" in text
+
+async def _complete(messages):
+    """Stream a completion for messages and return the generated text."""
+    global _JSON_MODE
+    # Import openai before the try below, whose except clause looks it up
+    _client()
+    # Streaming lets the read timeout act on gaps between chunks, so a long
+    # but steadily generating answer is not cut off like a stalled one
+    kwargs = dict(model=MODEL, messages=messages, stream=True)
+    if _JSON_MODE:
+        try:
+            # JSON mode makes the server guarantee a parseable JSON object
+            return await _stream_text(response_format={"type": "json_object"}, **kwargs)
+        except openai.BadRequestError as e:
+            # Not every DashScope model accepts response_format; retry without
+            # it and only rely on the prompt from then on if that succeeds.
+            # Other rejections (bad image URL, content inspection, oversized
+            # input) would fail the same way again, so they are raised as is.
+            if not _is_json_mode_error(e):
+                raise
+            text = await _stream_text(**kwargs)
+            _JSON_MODE = False
+            return text
+    return await _stream_text(**kwargs)
+
+async def _image_part(image_url, prepared_url=None):
+    return {
+      "type": "image_url",
+      "image_url": {
+        "url": prepared_url or await _prepare_image_url(image_url)
+      }
+    }
+
+async def get_response(image_url, mode=DEFAULT_MODE, prepared_url=None):
+    """Analyze the food image at image_url and return the result as UTF-8 bytes.
+
+    mode selects the prompt from PROMPTS. prepared_url, when given, is the
+    already prepared URL to send in place of image_url. The analysis is
+    bounded by REQUEST_TIMEOUT; a schema retry only gets what is left of it,
+    so running out of time keeps the first answer.
+    """
+    deadline = time.monotonic() + REQUEST_TIMEOUT
+    key = None
+    if _USE_CACHE:
+        key = _cache_key(image_url, mode)
+        cached = _cache_get(key)
+        if cached is not None:
+            return cached
+
+    messages = [
+        {
+          "role": "system",
+          "content": PROMPTS[mode]
+        },
+        {
+          "role": "user",
+          "content": [
+            {
+              "type": "text",
+              "text": USER_TEXT
+            },
+            await asyncio.wait_for(_image_part(image_url, prepared_url), timeout=deadline - time.monotonic())
           ]
+        }
+    ]
+    content = await asyncio.wait_for(_complete(messages), timeout=deadline - time.monotonic())
+    if not content:
+        # Use a clear error marker that processFoodAnalysis can handle
+        return b"ERROR PROCESSING IMAGE: the model returned no content"
+
+    # Try to ensure we're returning valid JSON
+    food_json = _parse_content(content)
+    if food_json is None:
+        # If all parsing attempts fail, return the original content
+        return content.encode()
+    _coerce_calories(food_json)
+
+    error = _schema_error(food_json, mode)
+    if error is not None:
+        # Ask once more, telling the model what was wrong with its answer
+        messages[0]["content"] = (
+            PROMPTS[mode] + f" Your previous reply did not match this schema ({error}); follow it exactly."
         )
-    
-    # Parse the JSON response
-    response_json = json.loads(completion.model_dump_json())
-    
-    # Extract and return just the content as plain text
-    if 'choices' in response_json and len(response_json['choices']) > 0:
-        content = response_json['choices'][0]['message']['content']
-        
-        # Try to ensure we're returning valid JSON
         try:
-            # Try to parse the response as JSON to check validity
-            food_json = json.loads(content)
-            # Then re-format it with proper indentation
-            return json.dumps(food_json, indent=2)
-        except json.JSONDecodeError:
-            # If the API didn't return proper JSON, try to extract any JSON-like content
-            import re
-            json_match = re.search(r'```json\s*(.*?)\s*```', content, re.DOTALL)
-            if json_match:
-                try:
-                    food_json = json.loads(json_match.group(1))
-                    return json.dumps(food_json, indent=2)
-                except:
-                    pass
-            
-            # If all parsing attempts fail, return the original content
-            return content
-    else:
-        # If no choices found, return the whole response as a string
-        # but with a clear error marker that processFoodAnalysis can handle
-        return "ERROR PROCESSING IMAGE: " + json.dumps(response_json, indent=2)
+            retry = await asyncio.wait_for(_complete(messages), timeout=deadline - time.monotonic())
+            retry_json = _parse_content(retry)
+        except Exception:
+            # Including running out of time: the first answer is still
+            # usable JSON, so return it, uncached
+            retry_json = None
+        if retry_json is not None:
+            food_json = _coerce_calories(retry_json)
+            error = _schema_error(food_json, mode)
+
+    # Then re-serialize it as compact single-line JSON
+    result = _json_dumps(food_json)
+    # Only output that matches the schema is cached
+    if key is not None and error is None:
+        _cache_put(key, result)
+    return result
+
+async def get_responses(image_urls, mode=DEFAULT_MODE):
+    """Analyze several food images in one request and return their results in order.
+
+    The images share a single completion, so the prompt is processed once
+    for all of them. Images the batched reply does not cover with a valid
+    result are analyzed one by one, each with its own concurrency permit
+    and timeout. An image whose own analysis fails has the exception in its
+    place in the returned list.
+    """
+    keys = [None] * len(image_urls)
+    results = [None] * len(image_urls)
+    if _USE_CACHE:
+        for i, image_url in enumerate(image_urls):
+            try:
+                keys[i] = _cache_key(image_url, mode)
+                results[i] = _cache_get(keys[i])
+            except Exception as e:
+                # e.g. an unreadable local file; only its own slot fails
+                results[i] = e
+    missing = [i for i, result in enumerate(results) if result is None]
+    # URLs already prepared for the batch, reused by the fallbacks so the
+    # images are not downloaded again
+    prepared = {}
+
+    if len(missing) > 1:
+        try:
+            async with _SEMAPHORE:
+                parts = await asyncio.gather(*(_image_part(image_urls[i]) for i in missing))
+                prepared = {i: part["image_url"]["url"] for i, part in zip(missing, parts)}
+                messages = [
+                    {
+                      "role": "system",
+                      "content": PROMPTS[mode] + BATCH_TEXT
+                    },
+                    {
+                      "role": "user",
+                      "content": [
+                        {
+                          "type": "text",
+                          "text": BATCH_USER_TEXT
+                        },
+                        *parts
+                      ]
+                    }
+                ]
+                content = await asyncio.wait_for(_complete(messages), timeout=REQUEST_TIMEOUT)
+        except Exception:
+            # Every image is retried on its own below
+            content = None
+        batch_json = _parse_content(content) if content else None
+        items = batch_json.get("results") if isinstance(batch_json, dict) else None
+        if isinstance(items, list) and len(items) == len(missing):
+            for i, food_json in zip(missing, items):
+                _coerce_calories(food_json)
+                if isinstance(food_json, dict) and _schema_error(food_json, mode) is None:
+                    results[i] = _json_dumps(food_json)
+                    if keys[i] is not None:
+                        _cache_put(keys[i], results[i])
+
+    missing = [i for i, result in enumerate(results) if result is None]
+    singles = await asyncio.gather(
+        *(_analyze(image_urls[i], mode, prepared.get(i)) for i in missing),
+        return_exceptions=True,
+    )
+    for i, result in zip(missing, singles):
+        results[i] = result
+    return results
+
+async def _analyze(image_url, mode, prepared_url=None):
+    # get_response enforces REQUEST_TIMEOUT itself, so that a slow schema
+    # retry can fall back to the first answer instead of being cancelled
+    async with _SEMAPHORE:
+        return await get_response(image_url, mode, prepared_url)
+
+async def _run(image_urls, mode, batch_size=1):
+    try:
+        if batch_size == 1:
+            # All images are analyzed concurrently, so the total wait is bounded
+            # by the slowest call rather than the sum of all of them
+            return await asyncio.gather(*(_analyze(url, mode) for url in image_urls), return_exceptions=True)
+        # Groups of batch_size images share a request; the groups themselves
+        # still run concurrently
+        groups = [image_urls[i:i + batch_size] for i in range(0, len(image_urls), batch_size)]
+        batches = await asyncio.gather(*(get_responses(group, mode) for group in groups), return_exceptions=True)
+        results = []
+        for group, batch in zip(groups, batches):
+            # A group that failed as a whole fails each of its images
+            results.extend([batch] * len(group) if isinstance(batch, BaseException) else batch)
+        return results
+    finally:
+        await _close_client()
+
+def _one_line(result):
+    # Anything that is not compact JSON (raw model text, errors) has its
+    # newlines escaped so each result stays on a single line. This is lossy:
+    # a literal backslash-n in the text reads back the same as an escaped
+    # newline, so readers should treat non-JSON results as display text only
+    return result.replace(b"\r", b"\\r").replace(b"\n", b"\\n")
+
+def _write_line(req_id, result):
+    sys.stdout.buffer.write(req_id.encode() + b" " + _one_line(result) + b"\n")
+    sys.stdout.buffer.flush()
+
+async def _serve(mode):
+    """Analyze image URLs read from stdin and write results to stdout as NDJSON.
+
+    Each input line is "<request id> <image url>", or just the URL, in which
+    case the 1-based line number is used as the id. Each output line is
+    "<request id> <result>". Several analyses run at once and results are
+    written as soon as they are ready, so the id is what matches them up.
+    """
+    loop = asyncio.get_running_loop()
+    tasks = set()
+
+    async def handle(req_id, image_url):
+        try:
+            result = await _analyze(image_url, mode)
+        except Exception as e:
+            result = f"ERROR PROCESSING IMAGE: {e!r}".encode()
+        _write_line(req_id, result)
+
+    try:
+        line_number = 0
+        while True:
+            line = await loop.run_in_executor(None, sys.stdin.readline)
+            if not line:
+                break
+            line_number += 1
+            parts = line.split(None, 1)
+            if not parts:
+                continue
+            if len(parts) == 1:
+                req_id, image_url = str(line_number), parts[0]
+            else:
+                req_id, image_url = parts[0], parts[1].strip()
+                if len(image_url.split()) != 1:
+                    _write_line(req_id, f"ERROR PROCESSING IMAGE: expected '<id> <url>', got {line.strip()!r}".encode())
+                    continue
+            task = asyncio.create_task(handle(req_id, image_url))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+    finally:
+        await _close_client()
+
+USAGE = """usage: analysis.py [--mode MODE] [--no-cache] [--safe] [--batch N] image_url [image_url ...]
+       analysis.py [--mode MODE] [--no-cache] [--safe] --daemon
+
+Analyze nutritional content in an image
+
+options:
+  --mode MODE  prompt to use: structured (default) or terse
+  --batch N    send up to N images per request (default 1)
+  --daemon     keep running and analyze "[id] image_url" lines read from stdin,
+               writing "id result" lines to stdout
+  --no-cache   always call the API instead of reusing cached analyses
+  --safe       parse responses through the OpenAI SDK's models (for debugging)"""
+
+def _parse_args(argv):
+    """Return (options, image_urls) for the command line arguments in argv.
+
+    Parsed by hand because importing argparse is a visible part of the
+    startup cost when a process is spawned per image.
+    """
+    options = {"--daemon": False, "--no-cache": False, "--safe": False, "--mode": DEFAULT_MODE, "--batch": 1}
+    image_urls = []
+    args = iter(argv)
+    for arg in args:
+        name, sep, value = arg.partition("=")
+        if arg in ("-h", "--help"):
+            print(USAGE)
+            sys.exit(0)
+        if name == "--mode":
+            value = value if sep else next(args, None)
+            if value not in PROMPTS:
+                _usage_error(f"argument --mode: expected one of {', '.join(PROMPTS)}")
+            options["--mode"] = value
+        elif name == "--batch":
+            value = value if sep else next(args, None)
+            if not (value or "").isdigit() or int(value) < 1:
+                _usage_error("argument --batch: expected a positive integer")
+            options["--batch"] = int(value)
+        elif arg in ("--daemon", "--no-cache", "--safe"):
+            options[arg] = True
+        elif arg.startswith("-"):
+            _usage_error(f"unrecognized argument: {arg}")
+        else:
+            image_urls.append(arg)
+    if not image_urls and not options["--daemon"]:
+        _usage_error("at least one image_url is required unless --daemon is given")
+    if MAX_CONCURRENCY < 1:
+        _usage_error(f"ANALYSIS_MAX_INFLIGHT must be a positive integer, got {_MAX_INFLIGHT!r}")
+    return options, image_urls
+
+def _usage_error(message):
+    print(f"{USAGE}\nanalysis.py: error: {message}", file=sys.stderr)
+    sys.exit(2)
 
 if __name__=='__main__':
-    parser = argparse.ArgumentParser(description='Analyze nutritional content in an image')
-    parser.add_argument('image_url', help='URL of the image to analyze')
-    
-    args = parser.parse_args()
+    options, image_urls = _parse_args(sys.argv[1:])
+    _USE_CACHE = not options["--no-cache"]
+    _SAFE = options["--safe"]
+    mode = options["--mode"]
+
+    if options["--daemon"]:
+        asyncio.run(_serve(mode))
+        sys.exit(0)
     
-    try:
-        result = get_response(args.image_url)
-        # Print the raw result with no additional formatting
-        # This will be captured by the Go code and passed to processFoodAnalysis
-        print(result)
-    except Exception as e:
-        # Print error in a way the Go code can recognize and handle
-        print(f"ERROR PROCESSING IMAGE: {e}", file=sys.stderr)
+    results = asyncio.run(_run(image_urls, mode, options["--batch"]))
+    failed = False
+    for result in results:
+        if isinstance(result, BaseException):
+            # Print error in a way the Go code can recognize and handle, and
+            # hold the failed URL's line on stdout so results stay in order
+            print(f"ERROR PROCESSING IMAGE: {result!r}", file=sys.stderr)
+            result = f"ERROR PROCESSING IMAGE: {result!r}".encode()
+            failed = True
+        # Write the result bytes with no re-encoding, one line per URL. This
+        # will be captured by the Go code and passed to processFoodAnalysis
+        sys.stdout.buffer.write(_one_line(result))
+        sys.stdout.buffer.write(b"\n")
+    sys.stdout.buffer.flush()
+    if failed:
         sys.exit(1)
@@ -1 +1 @@
-analysis.py
\ No newline at end of file
+../analysis.py
\ No newline at end of file
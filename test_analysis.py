@@ -0,0 +1,351 @@
+import asyncio
+import base64
+import io
+import json
+
+import pytest
+
+import analysis
+
+
+def _food(calories):
+    return {
+        "menu": "Nasi Goreng",
+        "description": "Fried rice",
+        "ingredients": ["rice"],
+        "allergens": ["Eggs"],
+        "nutritional_content": {
+            "calories": calories,
+            "macronutrients": {
+                name: {"amount": 10, "unit": "grams"} for name in ("protein", "carbohydrates", "fat")
+            },
+        },
+    }
+
+
+def _run_get_response(monkeypatch, replies, mode="terse"):
+    replies = list(replies)
+
+    async def fake_complete(messages):
+        reply = replies.pop(0)
+        if isinstance(reply, BaseException):
+            raise reply
+        return reply
+
+    async def fake_prepare(image_url):
+        return image_url
+
+    monkeypatch.setattr(analysis, "_USE_CACHE", False)
+    monkeypatch.setattr(analysis, "_complete", fake_complete)
+    monkeypatch.setattr(analysis, "_prepare_image_url", fake_prepare)
+    return asyncio.run(analysis.get_response("http://example.com/food.jpg", mode))
+
+
+def test_integral_float_calories_become_int(monkeypatch):
+    result = _run_get_response(monkeypatch, [json.dumps(_food(400.0))])
+
+    assert b'"calories":400,' in result
+    assert analysis._schema_error(json.loads(result), "terse") is None
+
+
+def test_failed_schema_retry_returns_first_answer(monkeypatch):
+    monkeypatch.setattr(analysis, "_schema_error", lambda food_json, mode: "data.menu must be string")
+    first = _food(400)
+    result = _run_get_response(monkeypatch, [json.dumps(first), TimeoutError()])
+
+    assert json.loads(result) == first
+
+
+def test_cache_key_ignores_oss_signature():
+    first = "https://b.oss-ap-southeast-5.aliyuncs.com/images/a.jpg?Expires=1&OSSAccessKeyId=K&Signature=S1"
+    second = "https://b.oss-ap-southeast-5.aliyuncs.com/images/a.jpg?Expires=2&OSSAccessKeyId=K&Signature=S2"
+    processed = "https://b.oss-ap-southeast-5.aliyuncs.com/images/a.jpg?x-oss-process=image/resize,w_100&Signature=S1"
+
+    assert analysis._cache_key(first, "terse") == analysis._cache_key(second, "terse")
+    assert analysis._cache_key(first, "terse") != analysis._cache_key(processed, "terse")
+
+
+def test_downscale_applies_exif_orientation():
+    Image = pytest.importorskip("PIL.Image")
+    buf = io.BytesIO()
+    exif = Image.Exif()
+    # Orientation 6: the camera was rotated, so the image displays 90 degrees turned
+    exif[0x0112] = 6
+    Image.new("RGB", (2000, 1000)).save(buf, "JPEG", exif=exif)
+
+    data_url = analysis._downscale(buf.getvalue())
+    image = Image.open(io.BytesIO(base64.b64decode(data_url.split(",", 1)[1])))
+
+    assert image.size == (512, 1024)
+
+
+def test_batch_fallbacks_respect_the_concurrency_cap(monkeypatch):
+    in_flight = 0
+    peak = 0
+
+    async def fake_complete(messages):
+        return '{"results": []}'
+
+    async def fake_get_response(image_url, mode, prepared_url=None):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return image_url.encode()
+
+    async def fake_prepare(image_url):
+        return image_url
+
+    async def run():
+        # The semaphore has to be created on the loop that uses it
+        monkeypatch.setattr(analysis, "_SEMAPHORE", asyncio.Semaphore(2))
+        return await analysis.get_responses([f"http://example.com/{i}.jpg" for i in range(5)], "terse")
+
+    monkeypatch.setattr(analysis, "_USE_CACHE", False)
+    monkeypatch.setattr(analysis, "_complete", fake_complete)
+    monkeypatch.setattr(analysis, "_prepare_image_url", fake_prepare)
+    monkeypatch.setattr(analysis, "get_response", fake_get_response)
+    results = asyncio.run(run())
+
+    assert results == [f"http://example.com/{i}.jpg".encode() for i in range(5)]
+    assert peak == 2
+
+
+def test_missing_openai_is_not_masked(monkeypatch):
+    def missing_client():
+        raise ImportError("No module named 'openai'")
+
+    monkeypatch.setattr(analysis, "openai", None)
+    monkeypatch.setattr(analysis, "_client", missing_client)
+    with pytest.raises(ImportError):
+        asyncio.run(analysis._complete([]))
+
+
+def test_serve_rejects_malformed_lines(monkeypatch, capfd):
+    async def fake_analyze(image_url, mode, prepared_url=None):
+        return b'{"url":"' + image_url.encode() + b'"}'
+
+    async def fake_close_client():
+        pass
+
+    monkeypatch.setattr(analysis, "_analyze", fake_analyze)
+    monkeypatch.setattr(analysis, "_close_client", fake_close_client)
+    monkeypatch.setattr("sys.stdin", io.StringIO("http://a/1.jpg\nr2 http://a/2.jpg\nr3 http://a/3.jpg extra\n"))
+    asyncio.run(analysis._serve("terse"))
+
+    lines = sorted(capfd.readouterr().out.splitlines())
+    assert lines[0] == '1 {"url":"http://a/1.jpg"}'
+    assert lines[1] == 'r2 {"url":"http://a/2.jpg"}'
+    assert lines[2].startswith("r3 ERROR PROCESSING IMAGE:")
+
+
+def test_closed_client_is_replaced_on_next_use():
+    pytest.importorskip("openai")
+
+    async def use_and_close():
+        client = analysis._client()
+        await analysis._close_client()
+        return client
+
+    first = asyncio.run(use_and_close())
+    second = asyncio.run(use_and_close())
+
+    assert first is not second
+    assert analysis._CLIENT is None and analysis._HTTP is None
+
+
+def test_unwritable_disk_cache_falls_back_to_memory(monkeypatch):
+    pytest.importorskip("diskcache")
+    monkeypatch.setattr(analysis, "CACHE_DIR", "/proc/nope/cache")
+    monkeypatch.setattr(analysis, "_DISK_CACHE", None)
+    monkeypatch.setattr(analysis, "_MEMORY_CACHE", analysis.OrderedDict())
+
+    analysis._cache_put("key", b"{}")
+
+    assert analysis._DISK_CACHE is False
+    assert analysis._cache_get("key") == b"{}"
+
+
+def test_failed_disk_write_keeps_the_answer(monkeypatch):
+    class FullDisk:
+        def get(self, key):
+            return None
+
+        def set(self, key, value):
+            raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(analysis, "_DISK_CACHE", FullDisk())
+    monkeypatch.setattr(analysis, "_DISK_ERRORS", (OSError,))
+    monkeypatch.setattr(analysis, "_MEMORY_CACHE", analysis.OrderedDict())
+
+    analysis._cache_put("key", b"{}")
+
+    assert analysis._DISK_CACHE is False
+    assert analysis._cache_get("key") == b"{}"
+
+
+def _bad_request(message):
+    openai = pytest.importorskip("openai")
+    httpx = pytest.importorskip("httpx")
+    request = httpx.Request("POST", "http://example.com/v1/chat/completions")
+    response = httpx.Response(400, request=request)
+    return openai.BadRequestError(message, response=response, body={"message": message})
+
+
+@pytest.mark.parametrize(
+    "message, fallback",
+    [("response_format unsupported", True), ("Download the media resource timed out", False)],
+)
+def test_only_json_mode_rejections_turn_json_mode_off(monkeypatch, message, fallback):
+    error = _bad_request(message)
+    calls = []
+
+    async def fake_stream_text(**kwargs):
+        calls.append(kwargs)
+        if len(calls) == 1:
+            raise error
+        return "{}"
+
+    monkeypatch.setattr(analysis, "_JSON_MODE", True)
+    monkeypatch.setattr(analysis, "_stream_text", fake_stream_text)
+    if fallback:
+        assert asyncio.run(analysis._complete([])) == "{}"
+        assert "response_format" not in calls[1]
+    else:
+        with pytest.raises(type(error)):
+            asyncio.run(analysis._complete([]))
+        assert len(calls) == 1
+    assert analysis._JSON_MODE is not fallback
+
+
+def test_stream_that_stalls_midway_is_retried(monkeypatch):
+    openai = pytest.importorskip("openai")
+    httpx = pytest.importorskip("httpx")
+    attempts = []
+
+    class FakeResponse:
+        headers = {}
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            return False
+
+    class FakeCompletions:
+        class with_streaming_response:
+            @staticmethod
+            def create(**kwargs):
+                return FakeResponse()
+
+    class FakeClient:
+        class chat:
+            completions = FakeCompletions
+
+    async def fake_join_events(response):
+        attempts.append(response)
+        if len(attempts) == 1:
+            raise httpx.ReadTimeout("stalled mid-stream")
+        return "{}"
+
+    monkeypatch.setattr(analysis, "_client", lambda: FakeClient)
+    monkeypatch.setattr(analysis, "openai", openai)
+    monkeypatch.setattr(analysis, "httpx", httpx)
+    monkeypatch.setattr(analysis, "_join_events", fake_join_events)
+
+    assert asyncio.run(analysis._stream_text(model="m", messages=[])) == "{}"
+    assert len(attempts) == 2
+
+
+@pytest.mark.parametrize(
+    "content_type, expected",
+    [
+        ("image/jpeg; charset=binary", "data:image/jpeg;base64,"),
+        ("binary/octet-stream", "data:image/png;base64,"),
+        ("application/octet-stream", None),
+    ],
+)
+def test_inlined_image_gets_an_image_mime_type(monkeypatch, content_type, expected):
+    Image = pytest.importorskip("PIL.Image")
+    httpx = pytest.importorskip("httpx")
+    image_url = "http://example.com/food.png"
+    buf = io.BytesIO()
+    Image.new("RGB", (8, 8)).save(buf, "PNG")
+    # The last case is not an image at all, so the URL is passed through
+    body = buf.getvalue() if expected else b"not an image"
+
+    def handler(request):
+        # A stream rather than content, so there is no content-length and
+        # the body has to be downloaded to learn its size
+        return httpx.Response(200, headers={"content-type": content_type}, stream=httpx.ByteStream(body))
+
+    async def run():
+        http = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        monkeypatch.setattr(analysis, "_http", lambda: http)
+        monkeypatch.setattr(analysis, "httpx", httpx)
+        async with http:
+            return await analysis._prepare_image_url(image_url)
+
+    result = asyncio.run(run())
+
+    assert result.startswith(expected) if expected else result == image_url
+
+
+def test_schema_retry_past_the_timeout_keeps_first_answer(monkeypatch):
+    first = _food(400)
+    replies = [json.dumps(first)]
+
+    async def fake_complete(messages):
+        if replies:
+            return replies.pop(0)
+        # The schema retry stalls well past the budget
+        await asyncio.sleep(10)
+
+    async def fake_prepare(image_url):
+        return image_url
+
+    monkeypatch.setattr(analysis, "REQUEST_TIMEOUT", 0.2)
+    monkeypatch.setattr(analysis, "_USE_CACHE", False)
+    monkeypatch.setattr(analysis, "_complete", fake_complete)
+    monkeypatch.setattr(analysis, "_prepare_image_url", fake_prepare)
+    monkeypatch.setattr(analysis, "_schema_error", lambda food_json, mode: "data.menu must be string")
+    result = asyncio.run(analysis._analyze("http://example.com/food.jpg", "terse"))
+
+    assert json.loads(result) == first
+
+
+def test_unreadable_image_only_fails_its_own_batch_slot(monkeypatch, tmp_path):
+    unreadable = tmp_path / "food.jpg"
+    unreadable.write_bytes(b"")
+
+    def fake_cache_key(image_url, mode):
+        if image_url == str(unreadable):
+            raise PermissionError(13, "Permission denied", image_url)
+        return image_url
+
+    async def fake_analyze(image_url, mode, prepared_url=None):
+        return image_url.encode()
+
+    async def fake_close_client():
+        pass
+
+    async def fake_complete(messages):
+        return None
+
+    async def fake_prepare(image_url):
+        return image_url
+
+    monkeypatch.setattr(analysis, "_USE_CACHE", True)
+    monkeypatch.setattr(analysis, "_MEMORY_CACHE", analysis.OrderedDict())
+    monkeypatch.setattr(analysis, "_DISK_CACHE", False)
+    monkeypatch.setattr(analysis, "_cache_key", fake_cache_key)
+    monkeypatch.setattr(analysis, "_complete", fake_complete)
+    monkeypatch.setattr(analysis, "_prepare_image_url", fake_prepare)
+    monkeypatch.setattr(analysis, "_analyze", fake_analyze)
+    monkeypatch.setattr(analysis, "_close_client", fake_close_client)
+    urls = ["http://example.com/1.jpg", str(unreadable), "http://example.com/3.jpg"]
+    results = asyncio.run(analysis._run(urls, "terse", batch_size=3))
+
+    assert results[0] == urls[0].encode() and results[2] == urls[2].encode()
+    assert isinstance(results[1], PermissionError)